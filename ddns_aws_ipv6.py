@@ -2,73 +2,335 @@
 
 import ipaddress
 import argparse
-import boto3
+import atexit
+import binascii
+import errno
+import functools
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import signal
+import socket
+import struct
+import sys
 import time
 
+# Re-check Route 53 at least this often even if the local addresses are unchanged
+STATE_MAX_AGE = 86400
+
+# Route 53 can take about a minute to serve a submitted change from its name servers
+CHANGE_PROPAGATION_TIME = 120
+
+# Route 53 errors worth retrying once botocore's own retries are exhausted
+RETRYABLE_ERRORS = ('Throttling', 'PriorRequestNotComplete')
+CHANGE_ATTEMPTS = 5
+
+# Delay before the daemon retries a failed update, doubled after each failure up to the maximum
+DAEMON_RETRY_DELAY = 30
+DAEMON_RETRY_MAX_DELAY = 900
+
+# Queue handlers feeding the background listener of each log file, keyed by file name
+_log_handlers = {}
+
+# Interface whose addresses are published
+INTERFACE = 'eth0'
+
+# rtnetlink constants from <linux/netlink.h>, <linux/rtnetlink.h> and <linux/if_addr.h>
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+RT_SCOPE_UNIVERSE = 0
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+RTNLGRP_IPV6_IFADDR = 9
+
+NLMSGHDR = struct.Struct('=IHHII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTATTR = struct.Struct('=HH')
+
+
+@functools.lru_cache(maxsize=8)
+def _make_client(profile):
+    # One Route 53 client per profile, so repeated updates in the same process
+    # reuse the credentials and the kept-alive HTTPS connection pool. boto3 is
+    # imported here because loading it dominates start-up for runs that exit early
+    import boto3
+    import botocore.config
+
+    config = botocore.config.Config(
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+        tcp_keepalive=True
+    )
+    return boto3.Session(profile_name=profile).client('route53', config=config)
+
+
+@functools.lru_cache(maxsize=32)
+def _is_global(raw):
+    # Reject unspecified, link-local and unique local addresses from the first
+    # bytes, and leave the remaining special-purpose ranges to ipaddress
+    if raw == bytes(16) or (raw[0] == 0xfe and raw[1] & 0xc0 == 0x80) or raw[0] & 0xfe == 0xfc:
+        return False
+    return ipaddress.IPv6Address(raw).is_global
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_v6(address):
+    # Return the packed form of a global IPv6 address given either as the 32 hex
+    # digits used by /proc/net/if_inet6 (str or bytes) or in colon notation, otherwise None
+    try:
+        if isinstance(address, str) and ':' in address:
+            raw = socket.inet_pton(socket.AF_INET6, address)
+        else:
+            raw = binascii.unhexlify(address)
+    except (OSError, ValueError):
+        return None
+
+    return raw if len(raw) == 16 and _is_global(raw) else None
+
+
+def _parse_ifaddr_messages(data):
+    # Yield (message type, interface index, scope, raw address) for each
+    # IPv6 address message in a netlink buffer, and a final NLMSG_DONE entry
+    # when the end of a dump is reached
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if msg_len < NLMSGHDR.size:
+            break
+
+        if msg_type == NLMSG_DONE:
+            yield NLMSG_DONE, 0, 0, None
+            return
+        if msg_type == NLMSG_ERROR:
+            error, = struct.unpack_from('=i', data, offset + NLMSGHDR.size)
+            if error:
+                raise OSError(-error, os.strerror(-error))
+        elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            family, _, _, scope, index = IFADDRMSG.unpack_from(data, offset + NLMSGHDR.size)
+            if family == socket.AF_INET6:
+                attr_offset = offset + NLMSGHDR.size + IFADDRMSG.size
+                end = offset + msg_len
+                while attr_offset + RTATTR.size <= end:
+                    attr_len, attr_type = RTATTR.unpack_from(data, attr_offset)
+                    if attr_len < RTATTR.size:
+                        break
+                    if attr_type == IFA_ADDRESS:
+                        raw = data[attr_offset + RTATTR.size:attr_offset + attr_len]
+                        yield msg_type, index, scope, raw
+                    attr_offset += (attr_len + 3) & ~3
+
+        offset += (msg_len + 3) & ~3
+
+
 class Route53DDNSIPv6:
+    # Fields shared by every "AAAA" record set this updater writes
+    _RRSET_TEMPLATE = {'Type': 'AAAA', 'TTL': 300}
+
     def __init__(self, profile, zone_id, hostname, verbose=False):
         self.profile = profile
         self.zone_id = zone_id
         self.hostname = hostname
-        self.client = self._get_route53_client()
-        self.logger = self._get_logger()
+        # Keyed on the zone as well, since one hostname may live in several hosted zones
+        self.state_file = os.path.expanduser(f'~/.cache/{hostname}_{zone_id}_ddns.json')
+        self._client = None
+        self._nameservers = None
         self.verbose = verbose
+        self.logger = self._get_logger()
+
+    @property
+    def client(self):
+        # Create the Route 53 client on first use so unchanged runs never build it
+        if self._client is None:
+            self._client = self._get_route53_client()
+        return self._client
 
     def _get_route53_client(self):
         # Initialize the Route 53 client using the specified AWS CLI profile
-        session = boto3.Session(profile_name=self.profile)
-        return session.client('route53')
+        return _make_client(self.profile)
 
     def _get_logger(self):
-        logger = logging.getLogger(__name__)
+        # A logger of its own, so this updater's verbose flag and log file only
+        # affect its own output even when several updaters share the process
+        logger = logging.Logger(__name__)
         logger.setLevel(logging.INFO)
 
-        # Create a file handler for logging
         log_file = f'{self.hostname}_ddns.log'
-        file_handler = logging.FileHandler(log_file)
+        if log_file not in _log_handlers:
+            # Create a file handler for logging; the file is only opened on the first record
+            file_handler = logging.FileHandler(log_file, delay=True)
+
+            # Create a formatter with Apache log format
+            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='[%d/%b/%Y:%H:%M:%S %z]')
+            file_handler.setFormatter(formatter)
 
-        # Create a formatter with Apache log format
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='[%d/%b/%Y:%H:%M:%S %z]')
-        file_handler.setFormatter(formatter)
+            # Write the file from a background thread so logging calls never block on I/O
+            log_queue = queue.Queue(-1)
+            listener = logging.handlers.QueueListener(log_queue, file_handler)
+            listener.start()
+            atexit.register(listener.stop)
+            _log_handlers[log_file] = logging.handlers.QueueHandler(log_queue)
 
-        # Add the file handler to the logger
-        logger.addHandler(file_handler)
+        # Add the queue handler to the logger
+        logger.addHandler(_log_handlers[log_file])
+
+        # Echo records to stdout, including informational ones only when verbose
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setLevel(logging.INFO if self.verbose else logging.WARNING)
+        logger.addHandler(stdout_handler)
 
         return logger
 
-    def _print_verbose(self, message):
-        if self.verbose:
-            print(message)
+    def _load_state(self):
+        # Load the last successfully applied address set, if any
+        try:
+            with open(self.state_file, 'r') as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, state):
+        # Record the address set that Route 53 now holds
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(self.state_file, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def _clear_state(self):
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
 
     def _get_public_ipv6_addresses(self):
-        # Get the IPv6 addresses from eth0 interface
+        # Ask the kernel over rtnetlink, falling back to procfs where netlink is unavailable
+        try:
+            return self._get_netlink_ipv6_addresses()
+        except (AttributeError, OSError):
+            return self._get_proc_ipv6_addresses()
+
+    def _get_netlink_ipv6_addresses(self):
+        # Dump the IPv6 addresses of the interface with a single RTM_GETADDR request
+        index = socket.if_nametoindex(INTERFACE)
         ipv6_addresses = []
+        # The same address can be listed more than once; dedupe on the packed bytes
+        seen = set()
+
+        request = NLMSGHDR.pack(
+            NLMSGHDR.size + IFADDRMSG.size, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, 1, 0
+        ) + IFADDRMSG.pack(socket.AF_INET6, 0, 0, 0, 0)
+
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.sendall(request)
+
+            done = False
+            while not done:
+                data = sock.recv(65536)
+                done = not data
+                for msg_type, ifindex, scope, raw in _parse_ifaddr_messages(data):
+                    if msg_type == NLMSG_DONE:
+                        done = True
+                    elif ifindex == index and scope == RT_SCOPE_UNIVERSE and len(raw) == 16:
+                        if raw not in seen and _is_global(raw):
+                            seen.add(raw)
+                            ipv6_addresses.append(ipaddress.IPv6Address(raw))
 
-        with open('/proc/net/if_inet6', 'r') as if_inet6:
-            for line in if_inet6:
-                parts = line.split()
-                if parts[5] == 'eth0':
-                    ipv6_address = parts[0]
+        return ipv6_addresses
 
-                    if ':' in ipv6_address:
-                        # IPv6 address already contains colons, use it as is
-                        formatted_ipv6 = ipv6_address
-                    else:
-                        # Insert colons into the IPv6 address string
-                        formatted_ipv6 = ':'.join(
-                            ipv6_address[i:i+4] for i in range(0, len(ipv6_address), 4)
-                        )
+    def _get_proc_ipv6_addresses(self):
+        # Get the IPv6 addresses from eth0 interface
+        ipv6_addresses = []
+        seen = set()
+
+        # Each line is "%32s %02x %02x %02x %02x %8s": the address is always the
+        # first 32 characters and the right-aligned interface name ends the line
+        suffix = b' ' + INTERFACE.encode()
+
+        # Read the raw bytes without Python's buffered/text io layers; procfs may
+        # return the file in several reads, so keep reading until EOF
+        chunks = []
+        fd = os.open('/proc/net/if_inet6', os.O_RDONLY)
+        try:
+            chunk = os.read(fd, 8192)
+            while chunk:
+                chunks.append(chunk)
+                chunk = os.read(fd, 8192)
+        finally:
+            os.close(fd)
+        data = b''.join(chunks)
+
+        for line in data.split(b'\n'):
+            if line.endswith(suffix):
+                raw = _parse_v6(line[:32])
+                if raw is not None and raw not in seen:
+                    seen.add(raw)
+                    ipv6_addresses.append(ipaddress.IPv6Address(raw))
+
+        return ipv6_addresses
 
+    def _get_zone_nameservers(self, state):
+        # Find the addresses of the name servers Route 53 assigned to the hosted zone
+        import botocore.exceptions
+        import dns.resolver
+
+        if self._nameservers is None:
+            names = state.get('nameservers')
+            if names is None:
+                try:
+                    zone = self.client.get_hosted_zone(Id=self.zone_id)
+                except botocore.exceptions.ClientError as e:
+                    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+                    if e.response['Error']['Code'] in RETRYABLE_ERRORS or status >= 500:
+                        # Transient, so look the zone up again on the next run
+                        self.logger.warning(f'Could not look up the hosted zone name servers: {e}')
+                        return []
+
+                    # Typically a policy without route53:GetHostedZone; remember that so
+                    # later runs go straight to the API instead of repeating the failing call
+                    self.logger.info(f'Reading the record through the Route 53 API: {e}')
+                    names = []
+                else:
+                    # Private hosted zones have no delegation set and can only be read through the API
+                    names = zone.get('DelegationSet', {}).get('NameServers', [])
+                state['nameservers'] = names
+
+            nameservers = []
+            for name in names:
+                # IPv6 first, since this tool mostly runs on IPv6 hosts
+                for rdtype in ('AAAA', 'A'):
                     try:
-                        ip = ipaddress.IPv6Address(formatted_ipv6)
-                        if ip.is_global:
-                            ipv6_addresses.append(ip)
-                    except ipaddress.AddressValueError:
-                        # Invalid IPv6 address
+                        nameservers.extend(a.address for a in dns.resolver.resolve(name, rdtype))
+                    except dns.resolver.NoAnswer:
                         pass
+            self._nameservers = nameservers
 
-        return ipv6_addresses
+        return self._nameservers
+
+    def _resolve_existing_aaaa_record_values(self, state):
+        # Ask the hosted zone's own name servers directly, which costs no Route 53 API
+        # quota; returns None when the zone cannot be queried over DNS
+        import dns.resolver
+
+        nameservers = self._get_zone_nameservers(state)
+        if not nameservers:
+            return None
+
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = nameservers
+        resolver.lifetime = 5
+
+        try:
+            answer = resolver.resolve(f'{self.hostname}.', 'AAAA')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return []
+
+        return [str(ipaddress.IPv6Address(record.address)) for record in answer]
 
     def _get_existing_aaaa_record_values(self):
         # Get the existing "AAAA" record values from Route 53
@@ -79,95 +341,192 @@ class Route53DDNSIPv6:
             MaxItems='1'
         )
 
-        record_values = []
-
-        if 'ResourceRecordSets' in response:
-            record_set = response['ResourceRecordSets'][0]
-            if record_set['Name'] == f'{self.hostname}.' and record_set['Type'] == 'AAAA':
-                record_values = [record['Value'] for record in record_set['ResourceRecords']]
-
-        return record_values
-
-    def _update_route53_aaaa_record(self, ipv6_addresses):
-        # Get the existing "AAAA" record values
-        existing_values = self._get_existing_aaaa_record_values()
-
-        # Check if the "AAAA" record exists
-        if existing_values:
-            # Filter out IPv6 addresses that already exist in Route 53
-            new_addresses = [str(addr) for addr in ipv6_addresses if str(addr) not in existing_values]
-
-            if not new_addresses:
-                self._print_verbose('Route 53 record is already up to date.')
-                self.logger.info('Route 53 record is already up to date.')
-                return
-
-            # Prepare the changes for the "AAAA" record in Route 53
-            changes = []
-            for address in new_addresses:
-                change = {
-                    'Action': 'UPSERT',
-                    'ResourceRecordSet': {
-                        'Name': f'{self.hostname}.',
-                        'Type': 'AAAA',
-                        'TTL': 300,
-                        'ResourceRecords': [
-                            {
-                                'Value': address
-                            }
-                        ]
-                    }
-                }
-                changes.append(change)
-
-        else:
-            # Create the "AAAA" record in Route 53
-            changes = [
-                {
-                    'Action': 'CREATE',
-                    'ResourceRecordSet': {
-                        'Name': f'{self.hostname}.',
-                        'Type': 'AAAA',
-                        'TTL': 300,
-                        'ResourceRecords': [
-                            {
-                                'Value': str(addr)
-                            } for addr in ipv6_addresses
-                        ]
-                    }
-                }
-            ]
+        record_sets = response.get('ResourceRecordSets')
+        if not record_sets:
+            return []
+
+        # The listing starts at the requested name and type, so anything else
+        # first means the record does not exist
+        record_set = record_sets[0]
+        if record_set['Name'] != f'{self.hostname}.' or record_set['Type'] != 'AAAA':
+            return []
+
+        return [record['Value'] for record in record_set.get('ResourceRecords', [])]
+
+    def _update_route53_aaaa_record(self, current, state):
+        # current is the sorted list of local addresses in text form
+        import dns.exception
+
+        # DNS may still serve the previous values while a change is pending, so only
+        # trust it when the last run succeeded and no change was submitted recently
+        existing_values = None
+        if 'mtime' in state and time.time() - state.get('changed', 0) > CHANGE_PROPAGATION_TIME:
+            try:
+                existing_values = self._resolve_existing_aaaa_record_values(state)
+            except dns.exception.DNSException:
+                pass
+
+        # Get the existing "AAAA" record values from the Route 53 API when DNS cannot be used
+        if existing_values is None:
+            existing_values = self._get_existing_aaaa_record_values()
+        existing_values = set(existing_values)
+
+        current_values = set(current)
+        to_add = current_values - existing_values
+        to_remove = existing_values - current_values
+
+        if not to_add and not to_remove:
+            self.logger.info('Route 53 record is already up to date.')
+            return False
+
+        for address in sorted(to_add):
+            self.logger.info(f'Adding {address}')
+        for address in sorted(to_remove):
+            self.logger.info(f'Removing {address}')
+
+        # UPSERT replaces the whole record set, which adds the new addresses and
+        # drops stale ones in one change, and also creates the record if missing
+        changes = [
+            {
+                'Action': 'UPSERT',
+                'ResourceRecordSet': dict(
+                    self._RRSET_TEMPLATE,
+                    Name=f'{self.hostname}.',
+                    ResourceRecords=[{'Value': value} for value in current]
+                )
+            }
+        ]
 
         # Update the "AAAA" record in Route 53
-        response = self.client.change_resource_record_sets(
-            HostedZoneId=self.zone_id,
-            ChangeBatch={
-                'Changes': changes
-            }
-        )
+        self._change_resource_record_sets(changes)
 
-        self._print_verbose('Route 53 record updated successfully.')
         self.logger.info('Route 53 record updated successfully.')
+        return True
+
+    def _change_resource_record_sets(self, changes):
+        # Back off with jitter on throttling so the update is not lost until the next run
+        import botocore.exceptions
+
+        for attempt in range(CHANGE_ATTEMPTS):
+            try:
+                return self.client.change_resource_record_sets(
+                    HostedZoneId=self.zone_id,
+                    ChangeBatch={
+                        'Changes': changes
+                    }
+                )
+            except botocore.exceptions.ClientError as e:
+                code = e.response['Error']['Code']
+                if code not in RETRYABLE_ERRORS or attempt == CHANGE_ATTEMPTS - 1:
+                    raise
+
+                delay = min(2 ** attempt + random.random(), 30)
+                self.logger.warning(f'Route 53 returned {code}, retrying in {delay:.1f}s.')
+                time.sleep(delay)
 
     def update_route53_record(self):
-        self._print_verbose('DNS record update process started.')
         self.logger.info('DNS record update process started.')
 
         # Get the public IPv6 addresses from eth0
         public_ipv6_addresses = self._get_public_ipv6_addresses()
 
         if public_ipv6_addresses:
-            # Update the corresponding "AAAA" records in Route 53 if they have changed
-            self._print_verbose('Attempting to update Route 53 record...')
-            self.logger.info('Attempting to update Route 53 record...')
-            self._update_route53_aaaa_record(public_ipv6_addresses)
+            # Compute the text form once; it is compared with the state and sent to Route 53
+            current = sorted(str(addr) for addr in public_ipv6_addresses)
+            state = self._load_state() or {}
+
+            if (state.get('addrs') == current
+                    and time.time() - state.get('mtime', 0) < STATE_MAX_AGE):
+                # Nothing changed since the last successful update
+                self.logger.info('No change in public IPv6 addresses since last update.')
+            else:
+                # Update the corresponding "AAAA" records in Route 53 if they have changed
+                import botocore.exceptions
+
+                self.logger.info('Attempting to update Route 53 record...')
+                try:
+                    changed = self._update_route53_aaaa_record(current, state)
+                except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                    self._clear_state()
+                    raise
+                state.update(addrs=current, mtime=time.time())
+                if changed:
+                    state['changed'] = state['mtime']
+                self._save_state(state)
         else:
-            self._print_verbose('No public IPv6 addresses found on eth0.')
             self.logger.warning('No public IPv6 addresses found on eth0.')
 
-        self._print_verbose('DNS record update process completed.')
         self.logger.info('DNS record update process completed.')
 
+    def run_daemon(self):
+        # Keep the record current by reacting to kernel address notifications instead of polling
+        index = socket.if_nametoindex(INTERFACE)
+
+        # Exit normally on SIGTERM so atexit stops the log listeners and flushes queued records
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.bind((0, 0))
+            # Subscribe before the initial update so no change can slip in between
+            sock.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, RTNLGRP_IPV6_IFADDR)
+
+            retry_delay = None
+            retry_at = None
+            update = True
+
+            while True:
+                if update:
+                    if self._update_from_daemon():
+                        retry_delay = retry_at = None
+                    else:
+                        # A failed update is retried on a timer, since no further
+                        # address notification may ever arrive on a static host
+                        if retry_delay is None:
+                            retry_delay = DAEMON_RETRY_DELAY
+                        else:
+                            retry_delay = min(retry_delay * 2, DAEMON_RETRY_MAX_DELAY)
+                        retry_at = time.monotonic() + retry_delay
+                        self.logger.warning(f'Retrying the update in {retry_delay}s.')
+
+                # Wait for the next notification, or until a pending retry is due
+                if retry_at is None:
+                    sock.settimeout(None)
+                else:
+                    timeout = retry_at - time.monotonic()
+                    if timeout <= 0:
+                        update = True
+                        continue
+                    sock.settimeout(timeout)
+
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    update = True
+                    continue
+                except OSError as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # Notifications were dropped, so re-check the addresses
+                    self.logger.warning('Netlink receive buffer overflowed, re-checking addresses.')
+                    update = True
+                    continue
+
+                update = any(ifindex == index for _, ifindex, _, _ in _parse_ifaddr_messages(data))
+
+    def _update_from_daemon(self):
+        # Route 53, network and state file errors must not stop the daemon; returns
+        # whether the update succeeded so run_daemon can schedule a retry
+        import botocore.exceptions
+
+        try:
+            self.update_route53_record()
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as e:
+            self.logger.error(f'Route 53 update failed: {e}')
+            return False
+
+        return True
+
+
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Update Route 53 AAAA record with public IPv6 addresses.')
@@ -175,10 +534,14 @@ if __name__ == '__main__':
     parser.add_argument('-z', '--zone-id', required=True, help='Route 53 hosted zone ID')
     parser.add_argument('-n', '--hostname', required=True, help='Hostname for the record set')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser.add_argument('-d', '--daemon', action='store_true', help='Keep running and update on address changes')
     args = parser.parse_args()
 
     # Create an instance of Route53DDNSIPv6
     updater = Route53DDNSIPv6(args.profile, args.zone_id, args.hostname, args.verbose)
 
     # Update the Route 53 record
-    updater.update_route53_record()
+    if args.daemon:
+        updater.run_daemon()
+    else:
+        updater.update_route53_record()
@@ -0,0 +1,380 @@
+import errno
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+import dns.exception
+import dns.resolver
+
+import ddns_aws_ipv6 as ddns
+
+ADDRESS = bytes.fromhex('26064700000000000000000000001111')
+
+
+def _attr(attr_type, payload):
+    # Pack an rtattr, padded to the 4-byte netlink alignment
+    attr = ddns.RTATTR.pack(ddns.RTATTR.size + len(payload), attr_type) + payload
+    return attr + b'\0' * (-len(attr) % 4)
+
+
+def _message(msg_type, payload):
+    return ddns.NLMSGHDR.pack(ddns.NLMSGHDR.size + len(payload), msg_type, 0, 1, 0) + payload
+
+
+def _ifaddr(msg_type, index, scope, *attrs, family=socket.AF_INET6):
+    return _message(msg_type, ddns.IFADDRMSG.pack(family, 64, 0, scope, index) + b''.join(attrs))
+
+
+def _make_updater(test):
+    # An updater whose state lives in a temporary directory and whose log output is discarded
+    logger = logging.Logger('test')
+    logger.addHandler(logging.NullHandler())
+    with mock.patch.object(ddns.Route53DDNSIPv6, '_get_logger', return_value=logger):
+        updater = ddns.Route53DDNSIPv6('profile', 'Z1', 'host.example.com')
+
+    state_dir = tempfile.TemporaryDirectory()
+    test.addCleanup(state_dir.cleanup)
+    updater.state_file = os.path.join(state_dir.name, 'state.json')
+    updater._client = mock.Mock()
+    return updater
+
+
+class ParseIfaddrMessagesTest(unittest.TestCase):
+    def test_multiple_messages_in_one_buffer(self):
+        other = bytes.fromhex('fe8000000000000000fc00fffe000001')
+        data = (
+            _ifaddr(ddns.RTM_NEWADDR, 4, ddns.RT_SCOPE_UNIVERSE, _attr(ddns.IFA_ADDRESS, ADDRESS))
+            + _ifaddr(ddns.RTM_DELADDR, 4, 253, _attr(ddns.IFA_ADDRESS, other))
+        )
+
+        self.assertEqual(list(ddns._parse_ifaddr_messages(data)), [
+            (ddns.RTM_NEWADDR, 4, ddns.RT_SCOPE_UNIVERSE, ADDRESS),
+            (ddns.RTM_DELADDR, 4, 253, other),
+        ])
+
+    def test_attribute_padding(self):
+        # A 5-byte label attribute needs 3 bytes of padding before IFA_ADDRESS
+        label = _attr(3, b'eth0\0')
+        self.assertEqual(len(label), 12)
+        data = _ifaddr(ddns.RTM_NEWADDR, 4, 0, label, _attr(ddns.IFA_ADDRESS, ADDRESS))
+
+        self.assertEqual(list(ddns._parse_ifaddr_messages(data)), [
+            (ddns.RTM_NEWADDR, 4, 0, ADDRESS),
+        ])
+
+    def test_done_stops_parsing(self):
+        data = (
+            _ifaddr(ddns.RTM_NEWADDR, 4, 0, _attr(ddns.IFA_ADDRESS, ADDRESS))
+            + _message(ddns.NLMSG_DONE, struct.pack('=i', 0))
+            + _ifaddr(ddns.RTM_NEWADDR, 5, 0, _attr(ddns.IFA_ADDRESS, ADDRESS))
+        )
+
+        self.assertEqual(list(ddns._parse_ifaddr_messages(data)), [
+            (ddns.RTM_NEWADDR, 4, 0, ADDRESS),
+            (ddns.NLMSG_DONE, 0, 0, None),
+        ])
+
+    def test_ack_is_skipped(self):
+        data = (
+            _message(ddns.NLMSG_ERROR, struct.pack('=i', 0) + ddns.NLMSGHDR.pack(16, 0, 0, 1, 0))
+            + _ifaddr(ddns.RTM_NEWADDR, 4, 0, _attr(ddns.IFA_ADDRESS, ADDRESS))
+        )
+
+        self.assertEqual(list(ddns._parse_ifaddr_messages(data)), [
+            (ddns.RTM_NEWADDR, 4, 0, ADDRESS),
+        ])
+
+    def test_error_raises(self):
+        data = _message(ddns.NLMSG_ERROR, struct.pack('=i', -errno.EPERM) + ddns.NLMSGHDR.pack(16, 0, 0, 1, 0))
+
+        with self.assertRaises(OSError) as cm:
+            list(ddns._parse_ifaddr_messages(data))
+        self.assertEqual(cm.exception.errno, errno.EPERM)
+
+    def test_ipv4_messages_are_ignored(self):
+        data = _ifaddr(ddns.RTM_NEWADDR, 4, 0, _attr(ddns.IFA_ADDRESS, b'\xc0\x00\x02\x01'), family=socket.AF_INET)
+
+        self.assertEqual(list(ddns._parse_ifaddr_messages(data)), [])
+
+
+class ParseV6Test(unittest.TestCase):
+    def test_procfs_hex(self):
+        self.assertEqual(ddns._parse_v6(b'26064700000000000000000000001111'), ADDRESS)
+        self.assertEqual(ddns._parse_v6('26064700000000000000000000001111'), ADDRESS)
+
+    def test_colon_notation(self):
+        self.assertEqual(ddns._parse_v6('2606:4700::1111'), ADDRESS)
+
+    def test_32_character_colon_notation(self):
+        address = '2606:470:1234:5678:9abc:def0:1:2'
+        self.assertEqual(len(address), 32)
+        self.assertEqual(ddns._parse_v6(address), socket.inet_pton(socket.AF_INET6, address))
+
+    def test_non_global_and_invalid(self):
+        self.assertIsNone(ddns._parse_v6(b'fe8000000000000000fc00fffe000001'))
+        self.assertIsNone(ddns._parse_v6(b'fd000000000000000000000000000002'))
+        self.assertIsNone(ddns._parse_v6('2001:db8::1'))
+        self.assertIsNone(ddns._parse_v6(b'zz064700000000000000000000001111'))
+        self.assertIsNone(ddns._parse_v6(b'2606'))
+
+
+class LoggerTest(unittest.TestCase):
+    def test_verbose_flag_is_per_instance(self):
+        verbose = ddns.Route53DDNSIPv6('profile', 'Z1', 'host.example.com', verbose=True)
+        quiet = ddns.Route53DDNSIPv6('profile', 'Z1', 'host.example.com', verbose=False)
+
+        def stdout_levels(updater):
+            return [handler.level for handler in updater.logger.handlers
+                    if type(handler) is logging.StreamHandler]
+
+        self.assertEqual(stdout_levels(verbose), [logging.INFO])
+        self.assertEqual(stdout_levels(quiet), [logging.WARNING])
+
+
+def _client_error(code, status):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+        'GetHostedZone'
+    )
+
+
+class ZoneNameserversTest(unittest.TestCase):
+    def test_access_denied_is_cached(self):
+        updater = _make_updater(self)
+        updater.client.get_hosted_zone.side_effect = _client_error('AccessDenied', 403)
+        state = {}
+
+        self.assertEqual(updater._get_zone_nameservers(state), [])
+        self.assertEqual(state, {'nameservers': []})
+
+    def test_transient_error_is_not_cached(self):
+        updater = _make_updater(self)
+        updater.client.get_hosted_zone.side_effect = _client_error('Throttling', 400)
+        state = {}
+
+        self.assertEqual(updater._get_zone_nameservers(state), [])
+        self.assertEqual(state, {})
+        self.assertIsNone(updater._nameservers)
+
+    def test_delegation_set_is_resolved_and_cached(self):
+        updater = _make_updater(self)
+        updater.client.get_hosted_zone.return_value = {
+            'DelegationSet': {'NameServers': ['ns-1.awsdns-01.org']}
+        }
+        answers = {
+            ('ns-1.awsdns-01.org', 'AAAA'): [mock.Mock(address='2600:9000:5301::1')],
+            ('ns-1.awsdns-01.org', 'A'): [mock.Mock(address='205.251.193.1')],
+        }
+        state = {}
+
+        with mock.patch('dns.resolver.resolve', side_effect=lambda name, rdtype: answers[name, rdtype]):
+            nameservers = updater._get_zone_nameservers(state)
+
+        self.assertEqual(nameservers, ['2600:9000:5301::1', '205.251.193.1'])
+        self.assertEqual(state, {'nameservers': ['ns-1.awsdns-01.org']})
+
+
+LOCAL = ['2606:4700::1111']
+STALE = ['2606:4700::2222']
+
+
+def _record_sets(values):
+    # A list_resource_record_sets response whose first record set is the hostname's AAAA set
+    return {'ResourceRecordSets': [{
+        'Name': 'host.example.com.',
+        'Type': 'AAAA',
+        'TTL': 300,
+        'ResourceRecords': [{'Value': value} for value in values],
+    }]}
+
+
+class _RecordTestCase(unittest.TestCase):
+    # Updater with stubbed local addresses, Route 53 client and DNS resolver
+    def setUp(self):
+        self.updater = _make_updater(self)
+        self.updater._get_public_ipv6_addresses = lambda: [ipaddress.IPv6Address(a) for a in LOCAL]
+        self.updater._nameservers = ['2600:9000:5301::1']
+        self.resolver = mock.Mock()
+        patcher = mock.patch('dns.resolver.Resolver', return_value=self.resolver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _dns_answers(self, values):
+        self.resolver.resolve.return_value = [mock.Mock(address=value) for value in values]
+
+    def _write_state(self, **state):
+        self.updater._save_state(dict({'addrs': STALE, 'mtime': time.time()}, **state))
+
+    def _upserted_values(self):
+        changes = self.updater.client.change_resource_record_sets.call_args.kwargs['ChangeBatch']['Changes']
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['Action'], 'UPSERT')
+        return [record['Value'] for record in changes[0]['ResourceRecordSet']['ResourceRecords']]
+
+
+class UpdateRecordTest(_RecordTestCase):
+    def test_first_run_uses_the_api(self):
+        self._dns_answers(LOCAL)
+        self.updater.client.list_resource_record_sets.return_value = _record_sets(STALE)
+
+        self.updater.update_route53_record()
+
+        self.resolver.resolve.assert_not_called()
+        self.updater.client.list_resource_record_sets.assert_called_once()
+        self.assertEqual(self._upserted_values(), LOCAL)
+        state = self.updater._load_state()
+        self.assertEqual(state['addrs'], LOCAL)
+        self.assertEqual(state['changed'], state['mtime'])
+
+    def test_recent_change_forces_the_api(self):
+        # DNS still serves the values from before the last change was applied
+        self._write_state(changed=time.time() - ddns.CHANGE_PROPAGATION_TIME + 30)
+        self._dns_answers(LOCAL)
+        self.updater.client.list_resource_record_sets.return_value = _record_sets(STALE)
+
+        self.updater.update_route53_record()
+
+        self.resolver.resolve.assert_not_called()
+        self.assertEqual(self._upserted_values(), LOCAL)
+
+    def test_dns_match_after_propagation_time_makes_no_change(self):
+        changed = time.time() - ddns.CHANGE_PROPAGATION_TIME - 30
+        self._write_state(changed=changed)
+        self._dns_answers(LOCAL)
+
+        self.updater.update_route53_record()
+
+        self.resolver.resolve.assert_called_once_with('host.example.com.', 'AAAA')
+        self.updater.client.list_resource_record_sets.assert_not_called()
+        self.updater.client.change_resource_record_sets.assert_not_called()
+        state = self.updater._load_state()
+        self.assertEqual(state['addrs'], LOCAL)
+        self.assertEqual(state['changed'], changed)
+
+    def test_nxdomain_is_created_with_upsert(self):
+        self._write_state()
+        self.resolver.resolve.side_effect = dns.resolver.NXDOMAIN()
+
+        self.updater.update_route53_record()
+
+        self.updater.client.list_resource_record_sets.assert_not_called()
+        self.assertEqual(self._upserted_values(), LOCAL)
+
+    def test_dns_failure_falls_back_to_the_api(self):
+        self._write_state()
+        self.resolver.resolve.side_effect = dns.exception.Timeout()
+        self.updater.client.list_resource_record_sets.return_value = _record_sets(LOCAL)
+
+        self.updater.update_route53_record()
+
+        self.updater.client.list_resource_record_sets.assert_called_once()
+        self.updater.client.change_resource_record_sets.assert_not_called()
+
+
+class RecordDiffTest(_RecordTestCase):
+    def test_stale_published_address_is_removed(self):
+        self.updater.client.list_resource_record_sets.return_value = _record_sets(LOCAL + STALE)
+
+        self.updater.update_route53_record()
+
+        self.assertEqual(self._upserted_values(), LOCAL)
+
+    def test_missing_record_is_created_with_upsert(self):
+        self.updater.client.list_resource_record_sets.return_value = {'ResourceRecordSets': []}
+
+        self.updater.update_route53_record()
+
+        self.assertEqual(self._upserted_values(), LOCAL)
+
+    def test_matching_record_is_not_changed(self):
+        self.updater.client.list_resource_record_sets.return_value = _record_sets(LOCAL)
+
+        self.updater.update_route53_record()
+
+        self.updater.client.change_resource_record_sets.assert_not_called()
+        self.assertEqual(self.updater._load_state()['addrs'], LOCAL)
+
+
+class _StopDaemon(Exception):
+    pass
+
+
+class _FakeNetlinkSocket:
+    # Stands in for the netlink socket: each recv() takes the next item from
+    # `results`, raising it if it is an exception
+    def __init__(self, results):
+        self.results = list(results)
+        self.timeouts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def bind(self, address):
+        pass
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def recv(self, size):
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+class RunDaemonTest(unittest.TestCase):
+    def test_failed_update_is_retried_without_an_event(self):
+        updater = _make_updater(self)
+        sock = _FakeNetlinkSocket([socket.timeout(), _StopDaemon()])
+        update = mock.Mock(side_effect=[
+            botocore.exceptions.EndpointConnectionError(endpoint_url='https://route53.amazonaws.com'),
+            None,
+        ])
+
+        with mock.patch.object(ddns.socket, 'socket', return_value=sock), \
+                mock.patch.object(ddns.socket, 'if_nametoindex', return_value=4), \
+                mock.patch.object(ddns.signal, 'signal'), \
+                mock.patch.object(updater, 'update_route53_record', update):
+            with self.assertRaises(_StopDaemon):
+                updater.run_daemon()
+
+        # The first wait after the failure has a retry timeout; after the retry
+        # succeeds the daemon blocks until the next notification again
+        self.assertEqual(update.call_count, 2)
+        self.assertEqual(len(sock.timeouts), 2)
+        self.assertGreater(sock.timeouts[0], 0)
+        self.assertLessEqual(sock.timeouts[0], ddns.DAEMON_RETRY_DELAY)
+        self.assertIsNone(sock.timeouts[1])
+
+    def test_unrelated_events_do_not_update(self):
+        updater = _make_updater(self)
+        other_interface = _ifaddr(ddns.RTM_NEWADDR, 7, 0, _attr(ddns.IFA_ADDRESS, ADDRESS))
+        sock = _FakeNetlinkSocket([other_interface, _StopDaemon()])
+        update = mock.Mock()
+
+        with mock.patch.object(ddns.socket, 'socket', return_value=sock), \
+                mock.patch.object(ddns.socket, 'if_nametoindex', return_value=4), \
+                mock.patch.object(ddns.signal, 'signal'), \
+                mock.patch.object(updater, 'update_route53_record', update):
+            with self.assertRaises(_StopDaemon):
+                updater.run_daemon()
+
+        self.assertEqual(update.call_count, 1)
+        self.assertEqual(sock.timeouts, [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()